@@ -1,22 +1,196 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import importlib.metadata
+import importlib.util
+from html import escape as html_escape, unescape as html_unescape
+import json
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
 import sys
 import subprocess
+import tempfile
 from pathlib import Path
 import re
+import socket
+import string
 
 
 def read_text(path: Path) -> str:
-    return path.read_text(encoding="utf-8")
+    # Decode straight out of a read-only mapping: one copy instead of read() + decode().
+    with path.open("rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # empty file, pipe, ...
+            return f.read().decode("utf-8")
+        with mm:
+            return str(mm, "utf-8")
+
+
+_MATH_PROTECT_RE = re.compile(
+    r"(?P<code>^[ \t]*(?P<fence>`{3,}|~{3,}).*?^[ \t]*(?P=fence)|(?P<tick>`+)[^`\n][^\n]*?(?P=tick))"
+    r"|(?<!\\)\$\$(?P<block>.+?)(?<!\\)\$\$"
+    r"|(?<![\\$])\$(?![\s$])(?P<inline>[^$\n]+?)(?<![\s\\])\$(?![\d$])",
+    re.MULTILINE | re.DOTALL,
+)
+# Math placeholders are "\ue000<n>\ue001" (percent-encoded in links); input \ue000 is escaped first.
+_MATH_ESCAPED = "\ue000x\ue001"
+_MATH_ESCAPED_URL = "%EE%80%80x%EE%80%81"
+# Tokens inside <pre>/<code> or a tag are not math and get their $...$ source back.
+_MATH_TOKEN_RE = re.compile(
+    r"(?P<open_p><p>)?\ue000(?P<index>\d+)\ue001(?P<close_p></p>)?"
+    r"|(?P<code><(?P<tag>pre|code)\b[^>]*>.*?</(?P=tag)>)"
+    r"|(?P<markup><[^>]*>)",
+    re.DOTALL,
+)
+_MATH_BARE_TOKEN_RE = re.compile(r"(?:\ue000|%EE%80%80)(\d+)(?:\ue001|%EE%80%81)")
+# GFM table delimiter row (|---|:--:|); the header row is the line above it.
+_TABLE_DELIM_RE = re.compile(r"^[ \t]*(?=[^\n]*\|)\|?(?:[ \t]*:?-+:?[ \t]*\|)*[ \t]*:?-+:?[ \t]*\|?[ \t]*$", re.MULTILINE)
+_TABLE_END_RE = re.compile(r"\n[ \t]*(?:\n|$)")
+_CELL_PIPE_RE = re.compile(r"(?<!\\)\|")
+_HEADING_RE = re.compile(r"<h([1-6])>(.*?)</h\1>", re.DOTALL)
+
+
+def _table_ranges(md_text: str):
+    ranges = []
+    if "|" not in md_text:
+        return ranges
+    for m in _TABLE_DELIM_RE.finditer(md_text):
+        start = md_text.rfind("\n", 0, max(m.start() - 1, 0)) + 1
+        end = _TABLE_END_RE.search(md_text, m.end())
+        ranges.append((start, end.start() if end else len(md_text)))
+    return ranges
+
+
+def _protect_math(md_text: str):
+    if "\ue000" in md_text:
+        md_text = md_text.replace("\ue000", _MATH_ESCAPED)
+    tables = _table_ranges(md_text)
+    spans = []
+    pieces = []
+    pos = 0
+    m = _MATH_PROTECT_RE.search(md_text)
+    while m:
+        if m.group("code") is not None:
+            pieces.append(md_text[pos:m.end()])
+            pos = m.end()
+        elif tables and _CELL_PIPE_RE.search(m.group(0)) and any(s < m.end() and m.start() < e for s, e in tables):
+            # The table parser splits cells before math is seen, so "$" must not span a "|".
+            m = _MATH_PROTECT_RE.search(md_text, m.start() + 1)
+            continue
+        else:
+            if m.group("block") is not None:
+                spans.append((True, m.group("block"), m.group(0)))
+            else:
+                spans.append((False, m.group("inline"), m.group(0)))
+            pieces.append(md_text[pos:m.start()])
+            pieces.append(f"\ue000{len(spans) - 1}\ue001")
+            pos = m.end()
+        m = _MATH_PROTECT_RE.search(md_text, pos)
+    pieces.append(md_text[pos:])
+    return "".join(pieces), spans
+
+
+def _restore_math(body_html: str, spans) -> str:
+    # Same markup as pymdownx.arithmatex in generic mode.
+    if not spans:
+        return _unescape_math(body_html)
+
+    def source(m):
+        return html_escape(spans[int(m.group(1))][2])
+
+    def repl(m):
+        if m.group("index") is None:
+            markup = m.group("code") or m.group("markup")
+            if "\ue000" in markup or "%EE%80%80" in markup:
+                return _MATH_BARE_TOKEN_RE.sub(source, markup)
+            return markup
+        display, tex, _ = spans[int(m.group("index"))]
+        tex = html_escape(tex, quote=False)
+        open_p, close_p = m.group("open_p") or "", m.group("close_p") or ""
+        if display:
+            if open_p and close_p:
+                open_p = close_p = ""
+            return f"{open_p}<div class=\"arithmatex\">\\[{tex}\\]</div>{close_p}"
+        return f"{open_p}<span class=\"arithmatex\">\\({tex}\\)</span>{close_p}"
+
+    return _unescape_math(_MATH_TOKEN_RE.sub(repl, body_html))
+
+
+def _unescape_math(body_html: str) -> str:
+    if "\ue000" not in body_html and "%EE%80%80" not in body_html:
+        return body_html
+    return body_html.replace(_MATH_ESCAPED, "\ue000").replace(_MATH_ESCAPED_URL, "%EE%80%80")
+
+
+def _add_heading_ids(body_html: str) -> str:
+    # Slugs as the 'toc' extension makes them, so #anchors keep working.
+    seen = {}
+
+    def repl(m):
+        text = re.sub(r"<[^>]+>", "", m.group(2))
+        slug = re.sub(r"[^\w\s-]", "", html_unescape(text)).strip().lower()
+        slug = re.sub(r"[-\s]+", "-", slug) or "section"
+        count = seen.get(slug, 0)
+        seen[slug] = count + 1
+        if count:
+            slug = f"{slug}_{count}"
+        return f"<h{m.group(1)} id=\"{slug}\">{m.group(2)}</h{m.group(1)}>"
+
+    return _HEADING_RE.sub(repl, body_html)
+
+
+@functools.lru_cache(maxsize=None)
+def _markdown_backend():
+    # Fastest first: cmarkgfm -> mistune>=3 -> markdown.
+    try:
+        import cmarkgfm
+        from cmarkgfm.cmark import Options
+    except Exception:
+        pass
+    else:
+        options = Options.CMARK_OPT_UNSAFE | Options.CMARK_OPT_HARDBREAKS | Options.CMARK_OPT_FOOTNOTES
+        extensions = ["table", "autolink", "strikethrough", "tasklist"]
+
+        def parse_cmark(text):
+            return cmarkgfm.markdown_to_html_with_extensions(text, options=options, extensions=extensions)
+
+        return "cmarkgfm", parse_cmark
 
+    try:
+        import mistune
+        if int(mistune.__version__.split(".")[0]) < 3:
+            raise ImportError("mistune>=3 required")
+    except Exception:
+        pass
+    else:
+        parse_mistune = mistune.create_markdown(
+            escape=False,
+            hard_wrap=True,
+            plugins=["strikethrough", "table", "task_lists", "url", "footnotes"],
+        )
+        return "mistune", parse_mistune
 
-def build_html(md_text: str, title: str, css_text: str, base_url: str, enable_math: str, enable_mermaid: bool, theme: str) -> str:
     try:
         import markdown as md
     except Exception:
-        print("[ERROR] Missing dependency: markdown. Install via 'pip install markdown pymdown-extensions'", file=sys.stderr)
+        print("[ERROR] Missing dependency: markdown. Install via 'pip install cmarkgfm' or 'pip install markdown pymdown-extensions'", file=sys.stderr)
         sys.exit(1)
+    return "markdown", md.markdown
+
+
+def _parse_markdown(md_text: str, enable_math: str) -> str:
+    name, parse = _markdown_backend()
+    if name != "markdown":
+        spans = []
+        if enable_math != "none":
+            md_text, spans = _protect_math(md_text)
+        body_html = parse(md_text)
+        return _add_heading_ids(_restore_math(body_html, spans))
 
     extensions = [
         "extra",
@@ -42,186 +216,525 @@ def build_html(md_text: str, title: str, css_text: str, base_url: str, enable_ma
     except Exception:
         pass
 
-    body_html = md.markdown(md_text, extensions=extensions, extension_configs=extension_configs)
+    return parse(md_text, extensions=extensions, extension_configs=extension_configs)
+
+
+HIGHLIGHT_CSS_HREF = "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/github.min.css"
+HIGHLIGHT_JS_SRC = "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"
+MERMAID_JS_SRC = "https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js"
+GITHUB_MARKDOWN_CSS_HREF = "https://cdnjs.cloudflare.com/ajax/libs/github-markdown-css/5.2.0/github-markdown.min.css"
+MATHJAX_JS_SRC = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"
+KATEX_CSS_HREF = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css"
+KATEX_JS_SRC = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"
+KATEX_AUTO_JS_SRC = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"
+
+ASSETS_DIR = Path(__file__).resolve().parent / "assets"
+
+
+@functools.lru_cache(maxsize=None)
+def _read_asset(url: str):
+    path = ASSETS_DIR / url.rsplit("/", 1)[-1]
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError:
+        print(f"[WARN] Offline asset missing: {path}, falling back to {url}", file=sys.stderr)
+        return None
+    # Stylesheets reference fonts relative to themselves; point them at the assets directory.
+    return text.replace("url(fonts/", f"url({(ASSETS_DIR / 'fonts').as_uri()}/")
+
+
+# Everything --offline can inline; MathJax is left out (see _script_block).
+_OFFLINE_ASSETS = (
+    HIGHLIGHT_CSS_HREF,
+    HIGHLIGHT_JS_SRC,
+    GITHUB_MARKDOWN_CSS_HREF,
+    MERMAID_JS_SRC,
+    KATEX_CSS_HREF,
+    KATEX_JS_SRC,
+    KATEX_AUTO_JS_SRC,
+)
+
+
+def fetch_assets():
+    from urllib.request import urlopen
+
+    def download(url: str, dest: Path):
+        with urlopen(url, timeout=60) as resp:
+            data = resp.read()
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.write_bytes(data)
+        print(f"[OK] {url} -> {dest}")
+
+    for url in _OFFLINE_ASSETS:
+        download(url, ASSETS_DIR / url.rsplit("/", 1)[-1])
+    katex_css = (ASSETS_DIR / KATEX_CSS_HREF.rsplit("/", 1)[-1]).read_text(encoding="utf-8")
+    katex_base = KATEX_CSS_HREF.rsplit("/", 1)[0]
+    for font in sorted(set(re.findall(r"url\(fonts/([^)]+)\)", katex_css))):
+        download(f"{katex_base}/fonts/{font}", ASSETS_DIR / "fonts" / font)
+
+
+def _style_tag(href: str, offline: bool) -> str:
+    css = _read_asset(href) if offline else None
+    if css is None:
+        return f'<link rel="stylesheet" href="{href}">'
+    return f"<style>{css}</style>"
+
+
+def _script_tag(src: str, offline: bool) -> str:
+    js = _read_asset(src) if offline else None
+    if js is None:
+        return f'<script src="{src}"></script>'
+    return "<script>" + js.replace("</script", "<\\/script") + "</script>"
+
+
+_HTML_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>$title</title>
+    $base_tag
+    $highlight_css
+    $theme_links
+    <style>
+$styles
+    </style>
+  </head>
+  <body>
+    <main class="markdown-body">$body</main>
+$scripts
+  </body>
+</html>
+""")
+
+
+_HIGHLIGHT_INIT_JS = "try{hljs.highlightAll();}catch(e){};"
+
+_MERMAID_INIT_JS = """
+function transformMermaidBlocks(){
+  const blocks = Array.from(document.querySelectorAll('pre > code.language-mermaid'));
+  for (const code of blocks) {
+    const pre = code.parentElement;
+    const div = document.createElement('div');
+    div.className = 'mermaid';
+    div.textContent = code.textContent;
+    pre.replaceWith(div);
+  }
+}
+window.addEventListener('load', function(){
+  transformMermaidBlocks();
+  if (window.mermaid) { mermaid.initialize({startOnLoad: true}); }
+});
+"""
+
+_MATHJAX_INIT_JS = """
+window.addEventListener('load', function(){
+  if (window.MathJax && MathJax.typesetPromise) { MathJax.typesetPromise(); }
+});
+"""
+
+_KATEX_INIT_JS = """
+window.addEventListener('load', function(){
+  if (window.renderMathInElement) {
+    renderMathInElement(document.body, {
+      delimiters: [
+        {left: '$$', right: '$$', display: true},
+        {left: '$', right: '$', display: false},
+        {left: '\\(', right: '\\)', display: false},
+        {left: '\\[', right: '\\]', display: true}
+      ]
+    });
+  }
+});
+"""
 
-    highlight_css_href = "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/github.min.css"
-    highlight_js_src = "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"
-    mermaid_js_src = "https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js" if enable_mermaid else ""
+_MATH_INIT_JS = {"mathjax": _MATHJAX_INIT_JS, "katex": _KATEX_INIT_JS}
 
-    github_markdown_css_href = "https://cdnjs.cloudflare.com/ajax/libs/github-markdown-css/5.2.0/github-markdown.min.css"
 
-    mathjax_js = ""
-    katex_css = ""
-    katex_js = ""
-    katex_auto_js = ""
-    math_init = ""
+@functools.lru_cache(maxsize=None)
+def _script_block(enable_math: str, enable_mermaid: bool, offline: bool = False) -> str:
+    parts = [
+        _script_tag(HIGHLIGHT_JS_SRC, offline),
+        f"<script>{_HIGHLIGHT_INIT_JS}</script>",
+    ]
+    if enable_mermaid:
+        parts.append(_script_tag(MERMAID_JS_SRC, offline))
+        parts.append(f"<script>{_MERMAID_INIT_JS}</script>")
     if enable_math == "mathjax":
-        mathjax_js = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"
-        math_init = """
-        <script>
-        window.addEventListener('load', function(){
-          if (window.MathJax && MathJax.typesetPromise) { MathJax.typesetPromise(); }
-        });
-        </script>
-        """
+        # MathJax loads its fonts relative to its own script URL, so it always comes from the CDN.
+        parts.append(f'<script src="{MATHJAX_JS_SRC}"></script>')
     elif enable_math == "katex":
-        katex_css = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css"
-        katex_js = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"
-        katex_auto_js = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"
-        math_init = """
-        <script>
-        window.addEventListener('load', function(){
-          if (window.renderMathInElement) {
-            renderMathInElement(document.body, {
-              delimiters: [
-                {left: '$$', right: '$$', display: true},
-                {left: '$', right: '$', display: false},
-                {left: '\\(', right: '\\)', display: false},
-                {left: '\\[', right: '\\]', display: true}
-              ]
-            });
-          }
-        });
-        </script>
-        """
-
-    mermaid_init = """
-    <script>
-    function transformMermaidBlocks(){
-      const blocks = Array.from(document.querySelectorAll('pre > code.language-mermaid'));
-      for (const code of blocks) {
-        const pre = code.parentElement;
-        const div = document.createElement('div');
-        div.className = 'mermaid';
-        div.textContent = code.textContent;
-        pre.replaceWith(div);
-      }
-    }
-    window.addEventListener('load', function(){
-      transformMermaidBlocks();
-      if (window.mermaid) { mermaid.initialize({startOnLoad: true}); }
-    });
-    </script>
-    """ if enable_mermaid else ""
+        parts.append(_style_tag(KATEX_CSS_HREF, offline))
+        parts.append(_script_tag(KATEX_JS_SRC, offline))
+        parts.append(_script_tag(KATEX_AUTO_JS_SRC, offline))
+    math_init = _MATH_INIT_JS.get(enable_math, "")
+    if math_init:
+        parts.append(f"<script>{math_init}</script>")
+    return "\n".join(parts)
+
+
+def build_html(md_text: str, title: str, css_text: str, base_url: str, enable_math: str, enable_mermaid: bool, theme: str, offline: bool = False, inline_styles: bool = True):
+    body_html = _parse_markdown(md_text, enable_math)
+    html = _wrap_html(body_html, title, css_text, base_url, enable_math, enable_mermaid, theme, offline, inline_styles)
+    return (html, *_content_features(body_html, enable_math, enable_mermaid))
+
+
+def _content_features(body_html: str, enable_math: str, enable_mermaid: bool):
+    # A leftover "$" may be math the parser did not wrap, which KaTeX auto-render still finds.
+    has_math = enable_math != "none" and ('class="arithmatex"' in body_html or "$" in body_html)
+    has_mermaid = enable_mermaid and 'class="language-mermaid"' in body_html
+    return has_math, has_mermaid
 
-    base_tag = f"<base href=\"{base_url}\">" if base_url else ""
 
-    theme_links = ""
-    theme_css = ""
+def _theme_stylesheets(css_text: str, theme: str):
+    hrefs = [HIGHLIGHT_CSS_HREF]
     if theme in ("github", "mpe"):
-        theme_links += f"<link rel=\"stylesheet\" href=\"{github_markdown_css_href}\">"
-    if theme == "mpe":
-        theme_css = MPE_CSS
-    elif theme == "github":
-        theme_css = ""
-    else:
-        theme_css = ""
-
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-      <head>
-        <meta charset="utf-8">
-        <title>{title}</title>
-        {base_tag}
-        <link rel="stylesheet" href="{highlight_css_href}">
-        {theme_links}
-        <style>
-        {DEFAULT_CSS}
-        {theme_css}
-        {css_text}
-        </style>
-      </head>
-      <body>
-        <main class="markdown-body">{body_html}</main>
-        <script src="{highlight_js_src}"></script>
-        <script>try{{hljs.highlightAll();}}catch(e){{}};</script>
-        {f'<script src="{mermaid_js_src}"></script>' if mermaid_js_src else ''}
-        {mermaid_init}
-        {f'<script src="{mathjax_js}"></script>' if mathjax_js else ''}
-        {f'<link rel="stylesheet" href="{katex_css}">' if katex_css else ''}
-        {f'<script src="{katex_js}"></script>' if katex_js else ''}
-        {f'<script src="{katex_auto_js}"></script>' if katex_auto_js else ''}
-        {math_init}
-      </body>
-    </html>
-    """
-    return html
+        hrefs.append(GITHUB_MARKDOWN_CSS_HREF)
+    return hrefs, _FROZEN_STYLES[theme] + "\n" + css_text
+
+
+def _wrap_html(body_html: str, title: str, css_text: str, base_url: str, enable_math: str, enable_mermaid: bool, theme: str, offline: bool = False, inline_styles: bool = True) -> str:
+    # With inline_styles=False the renderer supplies the stylesheets (WeasyPrintRenderer.prepare).
+    highlight_css = theme_links = styles = ""
+    if inline_styles:
+        hrefs, styles = _theme_stylesheets(css_text, theme)
+        highlight_css = _style_tag(hrefs[0], offline)
+        theme_links = "".join(_style_tag(href, offline) for href in hrefs[1:])
+
+    return _HTML_TEMPLATE.substitute(
+        title=title,
+        base_tag=f"<base href=\"{base_url}\">" if base_url else "",
+        highlight_css=highlight_css,
+        theme_links=theme_links,
+        styles=styles,
+        body=body_html,
+        scripts=_script_block(enable_math, enable_mermaid, offline),
+    )
+
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "md2pdf"
+# Once the cache grows past this, the least recently used entries are removed down to 3/4 of it.
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+
+def _dist_version(name: str) -> str:
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _cache_salt() -> str:
+    # Invalidate every entry when this script, the parser backend or its version changes.
+    script_digest = hashlib.blake2b(Path(__file__).read_bytes(), digest_size=16).hexdigest()
+    backend = _markdown_backend()[0]
+    versions = [_dist_version(backend)]
+    if backend == "markdown":
+        versions.append(_dist_version("pymdown-extensions"))
+    return f"{script_digest}:{backend}:{':'.join(versions)}"
+
+
+def _cache_key(md_text: str, options) -> str:
+    h = hashlib.blake2b()
+    h.update(md_text.encode("utf-8"))
+    h.update(json.dumps([_cache_salt(), options]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_read(key: str, suffix: str):
+    path = CACHE_DIR / f"{key[:32]}{suffix}"
+    try:
+        with open(path, encoding="utf-8", newline="") as f:
+            header = f.readline()
+            if header != f"<!-- md2pdf-cache {key} -->\n":
+                return None
+            text = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    # Touch the entry so _prune_cache treats mtime as last use.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return text
+
+
+def _cache_write(key: str, suffix: str, text: str):
+    path = CACHE_DIR / f"{key[:32]}{suffix}"
+    tmp = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(f"<!-- md2pdf-cache {key} -->\n")
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+def _prune_cache(max_bytes: int = CACHE_MAX_BYTES):
+    try:
+        entries = []
+        with os.scandir(CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith((".md", ".html", ".tmp")):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes * 3 // 4:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def _cached_fix_nested_lists(md_text: str) -> str:
+    key = _cache_key(md_text, ["fix_nested_lists"])
+    fixed = _cache_read(key, ".md")
+    if fixed is None:
+        fixed = fix_nested_lists(md_text)
+        _cache_write(key, ".md", fixed)
+    return fixed
+
+
+def _cached_parse_markdown(md_text: str, enable_math: str, enable_mermaid: bool):
+    # Only the body is cached; _wrap_html builds the page around it on every run.
+    key = _cache_key(md_text, ["parse_markdown", enable_math, enable_mermaid])
+    cached = _cache_read(key, ".html")
+    if cached is not None:
+        # First line holds the has_math/has_mermaid flags as two digits.
+        flags, _, body_html = cached.partition("\n")
+        return body_html, flags[:1] == "1", flags[1:2] == "1"
+    body_html = _parse_markdown(md_text, enable_math)
+    has_math, has_mermaid = _content_features(body_html, enable_math, enable_mermaid)
+    _cache_write(key, ".html", f"{int(has_math)}{int(has_mermaid)}\n{body_html}")
+    return body_html, has_math, has_mermaid
 
 
 class Renderer:
-    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str):
+    __slots__ = ()
+    name = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+    def prepare(self, css_text: str, theme: str, offline: bool = False, css_base_url: str = None):
+        return None
+
+    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str, outline: bool = False,
+               has_math: bool = True, has_mermaid: bool = True):
         raise NotImplementedError
 
 
 class PlaywrightRenderer(Renderer):
-    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str):
+    # cdp_port opens an (unauthenticated) DevTools port for other processes; cdp_endpoint attaches to one.
+    __slots__ = ("_pw", "_browser", "_context", "cdp_port", "cdp_endpoint", "channel")
+    name = "playwright"
+
+    def __init__(self):
+        self._pw = None
+        self._browser = None
+        self._context = None
+        self.cdp_port = None
+        self.cdp_endpoint = None
+        self.channel = "chromium-headless-shell"
+
+    def __enter__(self):
         from playwright.sync_api import sync_playwright
 
+        self._pw = sync_playwright().start()
+        try:
+            if self.cdp_endpoint:
+                self._browser = self._pw.chromium.connect_over_cdp(self.cdp_endpoint)
+            else:
+                args = [f"--remote-debugging-port={self.cdp_port}"] if self.cdp_port else []
+                self._browser = self._launch(args)
+            self._context = self._browser.new_context()
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def _launch(self, args):
+        try:
+            return self._pw.chromium.launch(channel=self.channel, args=args)
+        except Exception as e:
+            # Retry only for an unknown channel (Playwright < 1.49) or a build that is not installed.
+            message = str(e)
+            channel_error = ("Executable doesn't exist" in message
+                             or f'"{self.channel}"' in message or f"'{self.channel}'" in message)
+            if self.channel is None or not channel_error:
+                raise
+            first_error = message.strip().splitlines()[0]
+        try:
+            return self._pw.chromium.launch(args=args)
+        except Exception as e:
+            raise RuntimeError(f"{e} (after {self.channel} failed: {first_error})") from e
+
+    def shared_endpoint(self) -> str:
+        # The port was picked before Chromium bound it, so check that the endpoint answers.
+        endpoint = f"http://127.0.0.1:{self.cdp_port}"
+        self._pw.chromium.connect_over_cdp(endpoint).close()
+        return endpoint
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            # For a CDP-attached browser this only disconnects; the owner keeps it running.
+            if self._browser is not None:
+                self._browser.close()
+        finally:
+            if self._pw is not None:
+                self._pw.stop()
+            self._pw = self._browser = self._context = None
+
+    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str, outline: bool = False,
+               has_math: bool = True, has_mermaid: bool = True):
+        if self._context is None:
+            with self:
+                return self.render(html, output_path, base_url, page_size, margin, outline, has_math, has_mermaid)
+
         margin_parts = [p.strip() for p in margin.split(" ") if p.strip()]
         m_top = margin_parts[0] if len(margin_parts) > 0 else "20mm"
         m_right = margin_parts[1] if len(margin_parts) > 1 else m_top
         m_bottom = margin_parts[2] if len(margin_parts) > 2 else m_top
         m_left = margin_parts[3] if len(margin_parts) > 3 else m_right
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            page = browser.new_page()
-            page.set_content(html, wait_until="networkidle")
-            try:
-                page.wait_for_function("window.MathJax && MathJax.typesetPromise", timeout=5000)
-                page.evaluate("() => MathJax.typesetPromise()")
-            except Exception:
-                pass
-            try:
-                page.wait_for_function("window.mermaid && mermaid.initialize", timeout=5000)
-                page.evaluate("() => { try { if (window.mermaid) { mermaid.run(); } } catch(e){} }")
-            except Exception:
-                pass
-            pdf_bytes = page.pdf(format=page_size, margin={
+        page = self._context.new_page()
+        try:
+            # The load event rather than network idle, which adds at least 500ms of dead time per page.
+            page.set_content(html, wait_until="load")
+            ready = []
+            if has_math:
+                ready.append("(!window.MathJax || MathJax.typesetPromise)")
+            if has_mermaid:
+                ready.append("(!window.mermaid || mermaid.run)")
+            if ready:
+                try:
+                    page.wait_for_function(" && ".join(ready), timeout=5000)
+                except Exception:
+                    print(f"[WARN] MathJax/Mermaid not ready after 5s for {output_path.name}; rendering anyway.", file=sys.stderr)
+            if has_math:
+                try:
+                    page.evaluate("async () => { if (window.MathJax && MathJax.typesetPromise) { await MathJax.typesetPromise(); } }")
+                except Exception as e:
+                    print(f"[WARN] MathJax typesetting failed for {output_path.name}: {e}", file=sys.stderr)
+            if has_mermaid:
+                try:
+                    page.evaluate("async () => { if (window.mermaid) { await mermaid.run(); } }")
+                except Exception as e:
+                    print(f"[WARN] Mermaid rendering failed for {output_path.name}: {e}", file=sys.stderr)
+            # outline/tagged need Playwright >= 1.42; --batch asks for them so the split files keep bookmarks.
+            extra = {"outline": True, "tagged": True} if outline else {}
+            # Let Playwright write the file itself instead of handing the bytes back to us first.
+            page.pdf(path=str(output_path), format=page_size, margin={
                 "top": m_top,
                 "right": m_right,
                 "bottom": m_bottom,
                 "left": m_left,
-            }, print_background=True)
-            browser.close()
-        output_path.write_bytes(pdf_bytes)
+            }, print_background=True, **extra)
+        finally:
+            page.close()
 
 
 class WeasyPrintRenderer(Renderer):
-    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str):
+    # write_pdf stylesheets have user origin, so every sheet we own goes through self.stylesheets.
+    __slots__ = ("font_config", "stylesheets")
+    name = "weasyprint"
+
+    def __init__(self):
+        try:
+            from weasyprint.text.fonts import FontConfiguration
+        except ImportError:  # WeasyPrint < 53
+            from weasyprint.fonts import FontConfiguration
+        self.font_config = FontConfiguration()
+        self.stylesheets = []
+
+    def prepare(self, css_text: str, theme: str, offline: bool = False, css_base_url: str = None):
+        from weasyprint import CSS
+        from weasyprint.urls import URLFetchingError
+
+        hrefs, _ = _theme_stylesheets(css_text, theme)
+        stylesheets = []
+        for href in hrefs:
+            local = _read_asset(href) if offline else None
+            if local is not None:
+                stylesheets.append(CSS(string=local, font_config=self.font_config))
+                continue
+            try:
+                stylesheets.append(CSS(url=href, font_config=self.font_config))
+            except URLFetchingError as e:
+                # Same as WeasyPrint does for an unreachable <link>: report it and render without.
+                print(f"[WARN] Failed to load stylesheet {href}: {e}", file=sys.stderr)
+        stylesheets.append(CSS(string=_FROZEN_STYLES[theme], font_config=self.font_config))
+        if css_text:
+            # Relative url()/@import in --css resolve against the CSS file, not the input.
+            stylesheets.append(CSS(string=css_text, base_url=css_base_url, font_config=self.font_config))
+        self.stylesheets = stylesheets
+
+    def render(self, html: str, output_path: Path, base_url: str, page_size: str, margin: str, outline: bool = False,
+               has_math: bool = True, has_mermaid: bool = True):
+        # WeasyPrint always writes heading bookmarks, so outline needs no special handling.
         from weasyprint import HTML
-        HTML(string=html, base_url=base_url).write_pdf(str(output_path))
+        HTML(string=html, base_url=base_url).write_pdf(
+            str(output_path), stylesheets=self.stylesheets, font_config=self.font_config)
+
+
+def _module_available(name: str) -> bool:
+    # find_spec does not import the package; importing playwright or weasyprint is slow.
+    return importlib.util.find_spec(name) is not None
+
+
+# Engine name -> renderer class, in the order "auto" tries them.
+_RENDERERS = {
+    "playwright": PlaywrightRenderer,
+    "weasyprint": WeasyPrintRenderer,
+}
+_INSTALL_HINTS = {
+    "playwright": "Playwright not installed. Install via 'pip install playwright' and run 'playwright install'",
+    "weasyprint": "WeasyPrint not installed. Install via 'pip install weasyprint'",
+}
 
 
 def select_renderer(preference: str) -> Renderer:
+    # find_spec only proves the package is there; construction can still fail on missing native libs.
     if preference in (None, "", "auto"):
-        try:
-            import playwright  # noqa: F401
-            return PlaywrightRenderer()
-        except Exception:
+        for name, renderer_cls in _RENDERERS.items():
+            if not _module_available(name):
+                continue
             try:
-                import weasyprint  # noqa: F401
-                return WeasyPrintRenderer()
-            except Exception:
-                print("[ERROR] No PDF renderer available. Install 'playwright' or 'weasyprint'", file=sys.stderr)
-                sys.exit(2)
-    if preference == "playwright":
-        try:
-            import playwright  # noqa: F401
-            return PlaywrightRenderer()
-        except Exception:
-            print("[ERROR] Playwright not installed. Install via 'pip install playwright' and run 'playwright install'", file=sys.stderr)
-            sys.exit(2)
-    if preference == "weasyprint":
-        try:
-            import weasyprint  # noqa: F401
-            return WeasyPrintRenderer()
-        except Exception:
-            print("[ERROR] WeasyPrint not installed. Install via 'pip install weasyprint'", file=sys.stderr)
-            sys.exit(2)
-    print("[ERROR] Unknown engine preference", file=sys.stderr)
-    sys.exit(2)
+                return renderer_cls()
+            except Exception as e:
+                print(f"[WARN] {name} is installed but could not be loaded ({e}); trying the next engine.", file=sys.stderr)
+        print("[ERROR] No PDF renderer available. Install 'playwright' or 'weasyprint'", file=sys.stderr)
+        sys.exit(2)
+    renderer_cls = _RENDERERS.get(preference)
+    if renderer_cls is None:
+        print("[ERROR] Unknown engine preference", file=sys.stderr)
+        sys.exit(2)
+    if not _module_available(preference):
+        print(f"[ERROR] {_INSTALL_HINTS[preference]}", file=sys.stderr)
+        sys.exit(2)
+    try:
+        return renderer_cls()
+    except Exception as e:
+        print(f"[ERROR] {_INSTALL_HINTS[preference]} ({e})", file=sys.stderr)
+        sys.exit(2)
 
 
 DEFAULT_CSS = """
@@ -277,66 +790,266 @@ MPE_CSS = """
 }
 """
 
+
+def _minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r" ?([{};,]) ?", r"\1", css)
+    # Only safe because this runs on our own CSS, where ": " only appears inside declarations.
+    return css.replace(": ", ":").replace(";}", "}").strip()
+
+
+# Built-in styles per theme, minified once at import time.
+_FROZEN_STYLES = {
+    "mpe": _minify_css(DEFAULT_CSS + MPE_CSS),
+    "github": _minify_css(DEFAULT_CSS),
+    "minimal": _minify_css(DEFAULT_CSS),
+}
+
+_LIST_ITEM_RE = re.compile(
+    r"^(?:(?P<fence>[^\S\n]*```)"
+    r"|(?P<nested>[^\S\n]{2,}(?:(?P<bullet>[*+-])|\d+[.)])[^\S\n]+)"
+    r"|(?P<top>(?:(?P<star>\*)|[+-]|\d+[.)])[^\S\n]+))",
+    re.MULTILINE,
+)
+# Text without a list-item line needs no edits (other line breaks than "\n" skip the shortcut).
+_NEEDS_FIX_RE = re.compile(r"^[^\S\n]*(?:[*+-]|\d+[.)])\s", re.MULTILINE)
+_OTHER_LINE_BREAKS = "\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+_NESTED_ITEM_RE = re.compile(r"\s{2,}(?:[*+-]|\d+[.)])\s+")
+_TOP_BULLET_RE = re.compile(r"[*+-]\s+")
+_TOP_NUM_RE = re.compile(r"\d+[.)]\s+")
+
+
 def fix_nested_lists(md_text: str) -> str:
-    fence_re = re.compile(r"^\s*```")
-    bullet_re = re.compile(r"^\s{2,}[*+-]\s+")
-    top_bullet_re = re.compile(r"^[*+-]\s+")
-    num_re = re.compile(r"^\s{2,}\d+[\.)]\s+")
-    top_num_re = re.compile(r"^\d+[\.)]\s+")
-    lines = md_text.splitlines()
-    out = []
+    if not _NEEDS_FIX_RE.search(md_text) and not any(c in md_text for c in _OTHER_LINE_BREAKS):
+        return md_text
+    # Normalise line endings once, then visit only fence and list-item lines.
+    text = "\n".join(md_text.splitlines())
+    pieces = []
+    pos = 0
     in_code = False
-    prev = ""
-    for line in lines:
-        if fence_re.match(line):
+    for m in _LIST_ITEM_RE.finditer(text):
+        if m.group("fence") is not None:
             in_code = not in_code
-            out.append(line)
-            prev = line
             continue
-        is_nested = (not in_code) and (bullet_re.match(line) or num_re.match(line))
-        is_top_bullet = (not in_code) and top_bullet_re.match(line)
-        is_top_num = (not in_code) and top_num_re.match(line)
-        need_blank = (is_nested or is_top_bullet or is_top_num) and prev.strip() != "" and not bullet_re.match(prev) and not num_re.match(prev) and not top_bullet_re.match(prev)
+        if in_code:
+            continue
+        start = m.start()
+        prev = text[text.rfind("\n", 0, start - 1) + 1:start - 1] if start else ""
+        need_blank = prev.strip() != "" and not _NESTED_ITEM_RE.match(prev) and not _TOP_BULLET_RE.match(prev)
         if need_blank:
-            out.append("")
-        if (not in_code) and bullet_re.match(line):
-            if top_num_re.match(prev):
-                leading = len(re.match(r"^(\s+)", line).group(1)) if re.match(r"^(\s+)", line) else 0
-                if leading < 6:
-                    line = re.sub(r"^\s+", "      ", line)
-        if (not in_code) and top_bullet_re.match(line):
-            line = re.sub(r"^\*\s+", "- ", line)
-        if (not in_code) and top_num_re.match(line):
-            pass
-        out.append(line)
-        prev = line
-    return "\n".join(out)
+            pieces.append(text[pos:start])
+            pieces.append("\n")
+            pos = start
+        if m.group("bullet") is not None:
+            marker = m.start("bullet")
+            if marker - start < 6 and _TOP_NUM_RE.match(prev):
+                pieces.append(text[pos:start])
+                pieces.append("      ")
+                pos = marker
+        elif m.group("star") is not None:
+            pieces.append(text[pos:start])
+            pieces.append("- ")
+            pos = m.end("top")
+    pieces.append(text[pos:])
+    return "".join(pieces)
 
 
-def main():
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+_worker_renderer = None
+
+
+def _get_worker_renderer(options: dict, css_text: str) -> Renderer:
+    # One renderer per pool worker, closed when the worker exits.
+    global _worker_renderer
+    if _worker_renderer is None:
+        renderer = select_renderer(options["engine"])
+        if renderer.name == "playwright":
+            renderer.channel = options["browser_channel"]
+            renderer.cdp_endpoint = options["cdp_endpoint"]
+        renderer.prepare(css_text, options["theme"], options["offline"], options["css_base_url"])
+        try:
+            renderer.__enter__()
+        except Exception as e:
+            if renderer.name != "playwright" or not renderer.cdp_endpoint:
+                raise
+            print(f"[WARN] Could not attach to the shared browser ({e}); launching a separate one.", file=sys.stderr)
+            renderer.cdp_endpoint = None
+            renderer.__enter__()
+        # Renderers have __slots__ and no __weakref__; _worker_renderer keeps this one alive anyway.
+        multiprocessing.util.Finalize(None, renderer.__exit__, args=(None, None, None), exitpriority=10)
+        _worker_renderer = renderer
+    return _worker_renderer
+
+
+def _prepare_one(in_path: Path, options: dict, css_text: str, cover_part: str):
+    if options["output"]:
+        out_path = Path(options["output"]).resolve()
+    else:
+        out_path = in_path.with_suffix(".pdf")
+
+    out_dir = out_path.parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    base_url = in_path.parent.as_uri()
+
+    # cover_part already ends with a blank line, so a plain concatenation is enough.
+    md_text = cover_part + read_text(in_path)
+    # WeasyPrint gets its stylesheets pre-parsed from the renderer instead of inline.
+    inline_styles = options["engine"] != "weasyprint"
+    html_args = (options["title"], css_text, base_url, options["math"], options["mermaid"], options["theme"],
+                 options["offline"], inline_styles)
+    if options["no_cache"]:
+        md_text = fix_nested_lists(md_text)
+        body_html = _parse_markdown(md_text, options["math"])
+        has_math, has_mermaid = _content_features(body_html, options["math"], options["mermaid"])
+    else:
+        md_text = _cached_fix_nested_lists(md_text)
+        body_html, has_math, has_mermaid = _cached_parse_markdown(md_text, options["math"], options["mermaid"])
+    html = _wrap_html(body_html, *html_args)
+
+    if options["debug_html"]:
+        # Always with the styles inlined, so the page looks like the PDF.
+        debug_html = html if inline_styles else _wrap_html(body_html, *html_args[:-1], True)
+        out_path.with_suffix(".html").write_text(debug_html, encoding="utf-8")
+    return out_path, base_url, html, has_math, has_mermaid
+
+
+def _render_one(in_path: Path, options: dict, css_text: str, cover_part: str, renderer: Renderer = None) -> Path:
+    # Top-level so it can run in a worker process.
+    out_path, base_url, html, has_math, has_mermaid = _prepare_one(in_path, options, css_text, cover_part)
+    if renderer is None:
+        renderer = _get_worker_renderer(options, css_text)
+    renderer.render(html, out_path, base_url, options["page_size"], options["margin"],
+                    has_math=has_math, has_mermaid=has_mermaid)
+    return out_path
+
+
+_BATCH_ANCHOR = "md2pdf-source-"
+# Same-document anchors (heading slugs, footnotes) are prefixed per section so they stay unique.
+_SECTION_ANCHOR_RE = re.compile(r'(\sid="|\shref="#)(?=[^"])')
+_BATCH_CSS = """<style>
+.md2pdf-source + .md2pdf-source { break-before: page; }
+</style>"""
+
+
+def _copy_outline(reader, writer, items, first: int, last: int, parent=None):
+    # Bookmarks pointing into pages [first, last), keeping their nesting.
+    from pypdf.generic import Fit
+
+    prev = parent
+    for item in items:
+        if isinstance(item, list):
+            _copy_outline(reader, writer, item, first, last, prev)
+            continue
+        page = reader.get_destination_page_number(item)
+        if not first <= page < last:
+            prev = parent
+            continue
+        fit = Fit.xyz(item.left, item.top, item.zoom) if item.typ == "/XYZ" else Fit.fit()
+        prev = writer.add_outline_item(item.title, page - first, parent=parent, fit=fit)
+
+
+def _render_batch(inputs, options: dict, css_text: str, cover_part: str, renderer: Renderer):
+    # One render for all inputs, split at each section's named destination; raises if that fails.
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        raise RuntimeError("pypdf is not installed (pip install pypdf)")
+
+    sections = []
+    for i, in_path in enumerate(inputs):
+        md_text = cover_part + read_text(in_path)
+        if options["no_cache"]:
+            body_html = _parse_markdown(fix_nested_lists(md_text), options["math"])
+        else:
+            body_html, _, _ = _cached_parse_markdown(_cached_fix_nested_lists(md_text), options["math"], options["mermaid"])
+        body_html = _SECTION_ANCHOR_RE.sub(lambda m, prefix=f"s{i}-": m.group(1) + prefix, body_html)
+        anchor = f"{_BATCH_ANCHOR}{i}"
+        # Chromium only writes named destinations for ids that some link points at.
+        sections.append(
+            f"<section id=\"{anchor}\" class=\"md2pdf-source\" data-md2pdf-source=\"{html_escape(in_path.name)}\">"
+            f"<a href=\"#{anchor}\" hidden></a>\n{body_html}</section>"
+        )
+
+    base_dir = inputs[0].parent
+    base_url = base_dir.as_uri()
+    # The batch styles live in the body so they apply whether or not the renderer supplies the theme CSS.
+    body_html = "\n".join(sections)
+    has_math, has_mermaid = _content_features(body_html, options["math"], options["mermaid"])
+    html_args = (options["title"], css_text, base_url, options["math"], options["mermaid"], options["theme"],
+                 options["offline"])
+    inline_styles = options["engine"] != "weasyprint"
+    html = _wrap_html(_BATCH_CSS + body_html, *html_args, inline_styles)
+    if options["debug_html"]:
+        debug_html = html if inline_styles else _wrap_html(_BATCH_CSS + body_html, *html_args, True)
+        (base_dir / "md2pdf-batch.html").write_text(debug_html, encoding="utf-8")
+
+    fd, tmp_name = tempfile.mkstemp(suffix=".pdf", dir=base_dir)
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        renderer.render(html, tmp_path, base_url, options["page_size"], options["margin"], outline=True,
+                        has_math=has_math, has_mermaid=has_mermaid)
+        reader = PdfReader(str(tmp_path))
+
+        dests = reader.named_destinations
+        starts = [dests.get(f"{_BATCH_ANCHOR}{i}") for i in range(len(inputs))]
+        if None in starts:
+            raise RuntimeError("could not locate every input in the PDF")
+        bounds = [reader.get_destination_page_number(d) for d in starts] + [len(reader.pages)]
+        if bounds[0] != 0 or any(a >= b for a, b in zip(bounds, bounds[1:])):
+            raise RuntimeError("could not locate every input in the PDF")
+
+        out_paths = []
+        for i, in_path in enumerate(inputs):
+            writer = PdfWriter()
+            for page in reader.pages[bounds[i]:bounds[i + 1]]:
+                writer.add_page(page)
+            _copy_outline(reader, writer, reader.outline, bounds[i], bounds[i + 1])
+            out_path = in_path.with_suffix(".pdf")
+            with open(out_path, "wb") as f:
+                writer.write(f)
+            out_paths.append(out_path)
+        return out_paths
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _ensure_venv():
+    if os.environ.get("MD2PDF_VENV_ACTIVE") == "1":
+        return
+    if any(_module_available(name) for name in ("cmarkgfm", "mistune", "markdown")):
+        return
     venv_dir = Path.home() / ".md2pdf-venv"
     venv_python = venv_dir / "bin/python"
-    if os.environ.get("MD2PDF_VENV_ACTIVE") != "1":
+    if not venv_python.exists():
+        subprocess.run([sys.executable, "-m", "venv", str(venv_dir)], check=True)
+        subprocess.run([str(venv_python), "-m", "pip", "install", "--upgrade", "pip"], check=True)
+        subprocess.run([str(venv_python), "-m", "pip", "install", "cmarkgfm", "markdown", "pymdown-extensions", "playwright", "weasyprint", "pypdf"], check=True)
         try:
-            import markdown  # noqa: F401
+            subprocess.run([str(venv_python), "-m", "playwright", "install", "chromium-headless-shell"], check=True)
         except Exception:
-            if not venv_python.exists():
-                subprocess.run([sys.executable, "-m", "venv", str(venv_dir)], check=True)
-                subprocess.run([str(venv_python), "-m", "pip", "install", "--upgrade", "pip"], check=True)
-                subprocess.run([str(venv_python), "-m", "pip", "install", "markdown", "pymdown-extensions", "playwright", "weasyprint"], check=True)
-                try:
-                    subprocess.run([str(venv_python), "-m", "playwright", "install", "chromium"], check=True)
-                except Exception:
-                    pass
-            env = dict(os.environ)
-            env["MD2PDF_VENV_ACTIVE"] = "1"
-            os.execve(str(venv_python), [str(venv_python), str(Path(__file__).resolve())] + sys.argv[1:], env)
+            pass
+    env = dict(os.environ)
+    env["MD2PDF_VENV_ACTIVE"] = "1"
+    os.execve(str(venv_python), [str(venv_python), str(Path(__file__).resolve())] + sys.argv[1:], env)
+
+
+def main():
     parser = argparse.ArgumentParser(prog="md2pdf", description="Convert Markdown to PDF with browser or WeasyPrint backends")
-    parser.add_argument("input", nargs="+", help="Input Markdown file(s)")
+    parser.add_argument("input", nargs="*", help="Input Markdown file(s)")
     parser.add_argument("-o", "--output", help="Output PDF file (only for single input file)")
     parser.add_argument("--title", help="Document title", default="Document")
     parser.add_argument("--css", help="Additional CSS file")
     parser.add_argument("--engine", choices=["auto", "playwright", "weasyprint"], default="auto", help="Render engine")
+    parser.add_argument("--browser-channel", choices=["chromium-headless-shell", "chromium"], default="chromium-headless-shell",
+                        help="Chromium build for Playwright; the headless shell is smaller and starts faster (falls back to the default build)")
     parser.add_argument("--page-size", default="A4", help="Page size for Playwright")
     parser.add_argument("--margin", default="20mm", help="Margin for Playwright (CSS shorthand: top right bottom left)")
     parser.add_argument("--math", choices=["none", "mathjax", "katex"], default="mathjax", help="Enable math rendering")
@@ -344,16 +1057,40 @@ def main():
     parser.add_argument("--cover", help="Optional cover Markdown file")
     parser.add_argument("--theme", choices=["mpe", "github", "minimal"], default="mpe", help="Styling theme")
     parser.add_argument("--debug-html", action="store_true", help="Output intermediate HTML next to PDF")
+    parser.add_argument("--offline", "--offline-assets", dest="offline", action="store_true", help=f"Inline highlight.js, github-markdown-css, KaTeX and Mermaid from {ASSETS_DIR} instead of loading them from the CDN")
+    parser.add_argument("--fetch-assets", action="store_true", help=f"Download the assets used by --offline into {ASSETS_DIR} and exit")
+    parser.add_argument("--batch", action="store_true", help="Render all inputs in one browser pass and split the PDF per input (needs pypdf)")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of files rendered in parallel (default: min(inputs, CPUs, 4))")
+    parser.add_argument("--shared-browser", action="store_true",
+                        help="With -j, start one Chromium that all workers attach to instead of one per worker. "
+                             "It listens on an unauthenticated DevTools port on 127.0.0.1: any local user can "
+                             "control it (including file:// access) while md2pdf runs")
+    parser.add_argument("--no-cache", action="store_true", help=f"Do not read or write the rendered HTML cache ({CACHE_DIR})")
     args = parser.parse_args()
 
+    if args.fetch_assets:
+        try:
+            fetch_assets()
+        except OSError as e:
+            print(f"[ERROR] Failed to fetch assets: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    if not args.input:
+        parser.error("the following arguments are required: input")
+
+    # Only bootstrap dependencies once we know there is real work to do (not for --help).
+    _ensure_venv()
+
     # Resolve CSS once
     css_text = ""
+    css_base_url = None
     if args.css:
         css_path = Path(args.css).resolve()
         if not css_path.exists():
             print(f"[ERROR] CSS not found: {css_path}", file=sys.stderr)
             sys.exit(1)
         css_text = read_text(css_path)
+        css_base_url = css_path.parent.as_uri() + "/"
 
     # Resolve Cover once
     cover_part = ""
@@ -364,48 +1101,111 @@ def main():
             sys.exit(1)
         cover_part = read_text(cover_path) + "\n\n<div class=\"page-break\"></div>\n\n"
 
-    # Select renderer once
-    renderer = select_renderer(args.engine)
-    if isinstance(renderer, WeasyPrintRenderer) and (args.math != "none" or not args.no_mermaid):
-        print("[WARN] Using WeasyPrint: JavaScript-based features (Mermaid/MathJax/KaTeX) will not render.", file=sys.stderr)
-
     inputs = [Path(p).resolve() for p in args.input]
     if len(inputs) > 1 and args.output:
         print("[ERROR] The -o/--output argument is not supported when processing multiple files.", file=sys.stderr)
         sys.exit(1)
 
+    existing = []
     for in_path in inputs:
         if not in_path.exists():
             print(f"[WARN] Input not found: {in_path}, skipping.", file=sys.stderr)
             continue
+        existing.append(in_path)
+    inputs = existing
+    if not inputs:
+        return
 
-        if args.output:
-            out_path = Path(args.output).resolve()
-        else:
-            out_path = in_path.with_suffix(".pdf")
-
-        out_dir = out_path.parent
-        out_dir.mkdir(parents=True, exist_ok=True)
+    if not args.no_cache:
+        _prune_cache()
 
-        base_url = in_path.parent.as_uri()
+    # Select renderer once; the engine package itself is imported lazily on first use.
+    renderer = select_renderer(args.engine)
+    if renderer.name == "playwright":
+        renderer.channel = args.browser_channel
+    if renderer.name == "weasyprint" and (args.math != "none" or not args.no_mermaid):
+        print("[WARN] Using WeasyPrint: JavaScript-based features (Mermaid/MathJax/KaTeX) will not render.", file=sys.stderr)
 
-        parts = []
-        if cover_part:
-            parts.append(cover_part)
-        parts.append(read_text(in_path))
-        md_text = "\n\n".join(parts)
-        md_text = fix_nested_lists(md_text)
+    options = {
+        "output": args.output,
+        "title": args.title,
+        "engine": renderer.name,
+        "page_size": args.page_size,
+        "margin": args.margin,
+        "math": args.math,
+        "mermaid": not args.no_mermaid,
+        "theme": args.theme,
+        "debug_html": args.debug_html,
+        "no_cache": args.no_cache,
+        "offline": args.offline,
+        "cdp_endpoint": None,
+        "css_base_url": css_base_url,
+        "browser_channel": args.browser_channel,
+    }
 
-        html = build_html(md_text, args.title, css_text, base_url, args.math, not args.no_mermaid, args.theme)
+    if args.batch and len(inputs) > 1:
+        if len({p.parent for p in inputs}) > 1:
+            print("[WARN] --batch needs all inputs in one directory (shared base URL); rendering files individually.", file=sys.stderr)
+        else:
+            try:
+                renderer.prepare(css_text, args.theme, args.offline, options["css_base_url"])
+                with renderer:
+                    out_paths = _render_batch(inputs, options, css_text, cover_part, renderer)
+            except Exception as e:
+                print(f"[WARN] Batch render failed ({e}); rendering files individually.", file=sys.stderr)
+            else:
+                for out_path in out_paths:
+                    print(f"[OK] PDF generated: {out_path}")
+                return
 
-        if args.debug_html:
-            out_path.with_suffix(".html").write_text(html, encoding="utf-8")
+    jobs = min(len(inputs), args.jobs or min(os.cpu_count() or 1, 4))
+    if jobs <= 1:
+        # Parse ahead on a helper thread; the browser stays here (Playwright objects are thread-bound).
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prep:
+            next_job = prep.submit(_prepare_one, inputs[0], options, css_text, cover_part)
+            try:
+                renderer.prepare(css_text, args.theme, args.offline, options["css_base_url"])
+                with renderer:
+                    for i, in_path in enumerate(inputs):
+                        job = next_job
+                        if i + 1 < len(inputs):
+                            next_job = prep.submit(_prepare_one, inputs[i + 1], options, css_text, cover_part)
+                        try:
+                            out_path, base_url, html, has_math, has_mermaid = job.result()
+                            renderer.render(html, out_path, base_url, args.page_size, args.margin,
+                                            has_math=has_math, has_mermaid=has_mermaid)
+                            print(f"[OK] PDF generated: {out_path}")
+                        except Exception as e:
+                            print(f"[ERROR] Failed to render {in_path}: {e}", file=sys.stderr)
+            except Exception as e:
+                # Only renderer set-up/shutdown can get here; per-file errors are reported above.
+                print(f"[ERROR] Renderer failed: {e}", file=sys.stderr)
+                sys.exit(2)
+        return
 
+    # With --shared-browser, workers attach to one Chromium over CDP instead of launching their own.
+    mp_context = None
+    if renderer.name == "playwright" and args.shared_browser:
+        renderer.cdp_port = _free_port()
         try:
-            renderer.render(html, out_path, base_url, args.page_size, args.margin)
-            print(f"[OK] PDF generated: {out_path}")
+            renderer.__enter__()
+            options["cdp_endpoint"] = renderer.shared_endpoint()
         except Exception as e:
-            print(f"[ERROR] Failed to render {in_path}: {e}", file=sys.stderr)
+            renderer.__exit__(None, None, None)
+            print(f"[WARN] Could not start a shared browser ({e}); each worker will launch its own.", file=sys.stderr)
+        else:
+            # Don't fork a process that has a live Playwright connection.
+            mp_context = multiprocessing.get_context("spawn")
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as pool:
+            futures = {pool.submit(_render_one, in_path, options, css_text, cover_part): in_path for in_path in inputs}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    print(f"[OK] PDF generated: {future.result()}")
+                except Exception as e:
+                    print(f"[ERROR] Failed to render {futures[future]}: {e}", file=sys.stderr)
+    finally:
+        renderer.__exit__(None, None, None)
 
 
 if __name__ == "__main__":